@@ -7,10 +7,17 @@
 
 import os
 import io
+import re
 import zipfile
-from datetime import datetime, timedelta, timezone
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from types import MappingProxyType
+from typing import NamedTuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st
 
 try:
@@ -18,19 +25,45 @@ try:
 except ImportError:
     from backports.zoneinfo import ZoneInfo
 
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+try:
+    from ciso8601 import parse_datetime as _parse_iso
+except ImportError:
+    def _parse_iso(val):
+        return datetime.fromisoformat(val.replace("Z", "+00:00"))
+
 from dotenv import load_dotenv
 import fitz  # PyMuPDF
+import pandas as pd
 
 APP_TITLE = "Teapplix HD LTL BOL 產生器"
 TEMPLATE_PDF = "BOL.pdf"
 OUTPUT_DIR = "output_bols"
 BASE_URL  = "https://api.teapplix.com/api2/OrderNotification"
 STORE_KEY = "HD"
+TZ_PHX    = ZoneInfo("America/Phoenix")
 SHIPPED   = "0"     # 0 = 未出貨
 PAGE_SIZE = 500
+FETCH_WORKERS = 8   # 同時抓取的頁數
+
+CHECKBOX_FIELDS   = frozenset({"MasterBOL", "Term_Pre", "Term_Collect", "Term_CustChk", "FromFOB", "ToFOB"})
+FORCE_TEXT_FIELDS = frozenset({"PrePaid", "Collect", "3rdParty"})
+CHECKBOX_ON_VALUES = frozenset({"on", "yes", "1", "true", "x", "✔"})
 
-CHECKBOX_FIELDS   = {"MasterBOL", "Term_Pre", "Term_Collect", "Term_CustChk", "FromFOB", "ToFOB"}
-FORCE_TEXT_FIELDS = {"PrePaid", "Collect", "3rdParty"}
+SCAC_CARRIER_NAMES = MappingProxyType({
+    "EXLA": "Estes Express Lines",
+    "AACT": "AAA Cooper Transportation",
+    "CTII": "Central Transport Inc.",
+    "CETR": "Central Transport Inc.",
+    "ABF":  "ABF",
+    "PITD": "PITT Ohio",
+})
+
+TABLE_COLUMNS = ["Select", "Warehouse", "OriginalTxnId", "SKU8", "SCAC", "ToState", "OrderDate"]
 
 BILL_NAME         = "THE HOME DEPOT"
 BILL_ADDRESS      = "2455 PACES FERRY RD"
@@ -42,6 +75,13 @@ def _get_secret(name, default=""):
     return st.secrets.get(name, os.getenv(name, default))
 
 TEAPPLIX_TOKEN = _get_secret("TEAPPLIX_TOKEN", "")
+# 預設維持完整 DetailLevel；確認 "shipping" 仍會回傳 OrderItems / To 後，可用 secrets 改成 "shipping" 減少 payload
+DETAIL_LEVEL = _get_secret("TEAPPLIX_DETAIL_LEVEL", "shipping|inventory|marketplace")
+API_HEADERS = {
+    "APIToken": TEAPPLIX_TOKEN,
+    "Content-Type": "application/json;charset=UTF-8",
+    "Accept": "application/json",
+}
 
 # UI 倉庫代號：「CA 91789」「NJ 08816」
 WAREHOUSES = {
@@ -60,51 +100,26 @@ WAREHOUSES = {
 }
 
 # ---------- utils ----------
-def phoenix_range_days(days=3):
-    tz = ZoneInfo("America/Phoenix")
-    now = datetime.now(tz)
-    start = (now - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
-    end   = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    fmt = "%Y/%m/%d"
-    return start.strftime(fmt), end.strftime(fmt)
-
-def get_headers():
-    return {"APIToken": TEAPPLIX_TOKEN, "Content-Type": "application/json;charset=UTF-8", "Accept": "application/json"}
+def phoenix_today():
+    return datetime.now(TZ_PHX).date()
 
-def oz_to_lb(oz):
-    try: return round(float(oz)/16.0, 2)
-    except Exception: return None
-
-def summarize_packages(order):
-    details = order.get("ShippingDetails") or []
-    total_pkgs = 0
-    total_lb = 0.0
-    for sd in details:
-        pkg = sd.get("Package") or {}
-        count = int(pkg.get("IdenticalPackageCount") or 1)
-        wt = pkg.get("Weight") or {}
-        lb = oz_to_lb(wt.get("Value")) or 0.0
-        total_pkgs += max(1, count)
-        total_lb   += lb * max(1, count)
-    return total_pkgs, int(round(total_lb))
+def phoenix_range_days(days=3, today=None):
+    # 以鳳凰城當地日期計算，傳入同一個 today 結果就固定
+    today = today or phoenix_today()
+    start = today - timedelta(days=days)
+    fmt = "%Y/%m/%d"
+    return start.strftime(fmt), today.strftime(fmt)
 
 def override_carrier_name_by_scac(scac: str, current_name: str) -> str:
-    s = (scac or "").strip().upper()
-    mapping = {
-        "EXLA": "Estes Express Lines",
-        "AACT": "AAA Cooper Transportation",
-        "CTII": "Central Transport Inc.",
-        "CETR": "Central Transport Inc.",
-        "ABF":  "ABF",
-        "PITD": "PITT Ohio",
-    }
-    return mapping.get(s, current_name)
+    if not scac:
+        return current_name
+    return SCAC_CARRIER_NAMES.get(scac.strip().upper(), current_name)
 
 def group_by_original_txn(orders):
-    grouped = {}
+    grouped = defaultdict(list)
     for order in orders:
-        oid = (order.get("OriginalTxnId") or "").strip()
-        grouped.setdefault(oid, []).append(order)
+        oid = order.get("OriginalTxnId")
+        grouped[oid.strip() if oid else ""].append(order)
     return grouped
 
 def _first_item(order):
@@ -115,48 +130,56 @@ def _first_item(order):
         return items
     return {}
 
-def _desc_value_from_order(order):
-    sku = (_first_item(order).get("ItemSKU") or "")
-    return f"{sku}  (Electric Fireplace)".strip()
-
-def _sku8_from_order(order):
-    sku = (_first_item(order).get("ItemSKU") or "")
-    return sku[:8] if sku else ""
+class OrderView(NamedTuple):
+    # 單筆訂單第一個品項的常用欄位，一次取好
+    sku8: str
+    qty: int
+    desc: str
 
-def _qty_from_order(order):
+def _project(order) -> OrderView:
     it = _first_item(order)
-    try: return int(it.get("Quantity") or 0)
-    except Exception: return 0
+    sku = it.get("ItemSKU") or ""
+    try: qty = int(it.get("Quantity") or 0)
+    except Exception: qty = 0
+    return OrderView(
+        sku8=sku.strip()[:8],
+        qty=qty,
+        desc=f"{sku}  (Electric Fireplace)".strip(),
+    )
 
 def _sum_group_totals(group):
+    # 合單總箱數 / 總重（lb），單一迴圈走完所有 ShippingDetails
+    # 重量沿用原本規則：每箱 lb 取到小數兩位、每張訂單先四捨五入成整數再加總
     total_pkgs = 0
-    total_lb = 0.0
+    total_lb = 0
     for od in group:
-        pkgs, lb = summarize_packages(od)
-        total_pkgs += int(pkgs or 0)
-        total_lb   += float(lb or 0.0)
-    return total_pkgs, int(round(total_lb))
-
-def set_widget_value(widget, name, value):
-    try:
-        is_checkbox_type  = (widget.field_type == fitz.PDF_WIDGET_TYPE_CHECKBOX)
-        is_checkbox_named = (name in CHECKBOX_FIELDS)
-        is_forced_text    = (name in FORCE_TEXT_FIELDS)
-        is_checkbox       = (is_checkbox_type or is_checkbox_named) and not is_forced_text
-        if is_checkbox:
-            v = str(value).strip().lower()
-            widget.field_value = "Yes" if v in {"on","yes","1","true","x","✔"} else "Off"
-        else:
-            widget.field_value = "" if value is None else str(value)
-        widget.update()
-        return True
-    except Exception as e:
-        st.warning(f"填欄位 {name} 失敗：{e}")
-        return False
+        order_lb = 0.0
+        for sd in od.get("ShippingDetails") or ():
+            pkg = sd.get("Package") or {}
+            count = max(1, int(pkg.get("IdenticalPackageCount") or 1))
+            oz = (pkg.get("Weight") or {}).get("Value")
+            try: lb = round(float(oz) / 16.0, 2)
+            except (TypeError, ValueError): lb = 0.0
+            total_pkgs += count
+            order_lb += lb * count
+        total_lb += int(round(order_lb))
+    return total_pkgs, total_lb
+
+def _set_checkbox(widget, value):
+    v = str(value).strip().lower()
+    widget.field_value = "Yes" if v in CHECKBOX_ON_VALUES else "Off"
+    widget.update()
+
+def _set_text(widget, value):
+    widget.field_value = "" if value is None else str(value)
+    widget.update()
+
+FIELD_SETTERS = {"checkbox": _set_checkbox, "text": _set_text}
 
 # 訂單時間：只顯示日期（mm/dd/yy）
+_DATE_RE = re.compile(r"(\d{4})[-/](\d{1,2})[-/](\d{1,2})(?:[ T](\d{1,2}):(\d{2}):(\d{2}))?")
+
 def _parse_order_date_str(first_order):
-    tz_phx = ZoneInfo("America/Phoenix")
     od = first_order.get("OrderDetails") or {}
     candidates = [
         od.get("PaymentDate"),
@@ -170,19 +193,27 @@ def _parse_order_date_str(first_order):
         return ""
     val = str(raw).strip()
 
-    dt = None
+    # 只有日期（如 2024-01-05、2024/1/5）：不需時區換算，直接用拆出來的數字組字串
+    m = _DATE_RE.match(val)
+    if m and m.group(4) is None and m.end() == len(val):
+        y, mo, d = (int(g) for g in m.group(1, 2, 3))
+        try:
+            date(y, mo, d)  # 只驗證日期合法
+        except ValueError:
+            return ""
+        return f"{mo:02d}/{d:02d}/{y % 100:02d}"
+
+    # ISO-8601（T 或空白分隔、含 Z）走快速路徑，其餘（如 2024/01/05 10:00:00）用 regex 直接拆
     try:
-        if "T" in val:
-            dt = datetime.fromisoformat(val.replace("Z", "+00:00"))
-        else:
-            for fmt in ("%Y/%m/%d %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y/%m/%d", "%Y-%m-%d"):
-                try:
-                    dt = datetime.strptime(val, fmt)
-                    break
-                except Exception:
-                    continue
-    except Exception:
+        dt = _parse_iso(val)
+    except ValueError:
         dt = None
+    if dt is None:
+        if m:
+            try:
+                dt = datetime(*map(int, m.groups(default="0")))
+            except ValueError:
+                dt = None
 
     if dt is None:
         try:
@@ -191,50 +222,120 @@ def _parse_order_date_str(first_order):
             return ""
 
     if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=tz_phx)
-    dt_phx = dt.astimezone(tz_phx)
+        dt = dt.replace(tzinfo=TZ_PHX)
+    dt_phx = dt.astimezone(TZ_PHX)
     return dt_phx.strftime("%m/%d/%y")  # 僅日期
 
 # ---------- API ----------
-def fetch_orders(days: int):
-    ps, pe = phoenix_range_days(days)
-    page = 1
+class TeapplixAPIError(RuntimeError):
+    pass
+
+@st.cache_resource
+def _get_session():
+    # 共用連線池（keep-alive）+ 429/5xx 自動重試；Streamlit 每次 rerun 會重跑整個腳本，故以 cache_resource 保留
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(API_HEADERS)
+    return session
+
+def _total_pages(data, page_size):
+    # API 若有回傳總頁數 / 總筆數就用；沒有則回傳 None
+    try:
+        pages = data.get("TotalPages") or data.get("totalPages")
+        if pages:
+            return int(pages)
+        total = data.get("TotalCount") or data.get("Total") or data.get("total")
+        if total:
+            return -(-int(total) // page_size)
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def _fetch_page(session, params, page):
+    try:
+        r = session.get(BASE_URL, params={**params, "PageNumber": str(page)}, timeout=45)
+    except requests.RequestException as e:
+        raise TeapplixAPIError(f"連線錯誤：{e}")
+    if r.status_code != 200:
+        raise TeapplixAPIError(f"API 錯誤: {r.status_code}\n{r.text}")
+    try:
+        data = _json_loads(r.content)
+    except Exception:
+        raise TeapplixAPIError(f"JSON 解析錯誤：{r.text[:1000]}")
+    return data
+
+# 以 (天數, 鳳凰城日期) 為快取 key：跨日自動失效；「強制重抓」會呼叫 fetch_orders.clear()
+@st.cache_data(ttl=300, max_entries=8, show_spinner="抓取中…")
+def fetch_orders(days: int, today):
+    ps, pe = phoenix_range_days(days, today)
+    params = {
+        "PaymentDateStart": ps,
+        "PaymentDateEnd": pe,
+        "Shipped": SHIPPED,
+        "StoreKey": STORE_KEY,
+        "PageSize": str(PAGE_SIZE),
+        "Combine": "combine",
+        "DetailLevel": DETAIL_LEVEL,
+    }
+    session = _get_session()
     all_orders = []
-    while True:
-        params = {
-            "PaymentDateStart": ps,
-            "PaymentDateEnd": pe,
-            "Shipped": SHIPPED,
-            "StoreKey": STORE_KEY,
-            "PageSize": str(PAGE_SIZE),
-            "PageNumber": str(page),
-            "Combine": "combine",
-            "DetailLevel": "shipping|inventory|marketplace",
-        }
-        r = requests.get(BASE_URL, headers=get_headers(), params=params, timeout=45)
-        if r.status_code != 200:
-            st.error(f"API 錯誤: {r.status_code}\n{r.text}")
-            break
-        try:
-            data = r.json()
-        except Exception:
-            st.error(f"JSON 解析錯誤：{r.text[:1000]}")
-            break
-
-        orders = data.get("orders") or data.get("Orders") or []
-        if not orders: break
+    seen = set()
 
+    def keep(orders):
+        # 回傳本頁新出現的訂單數；分頁位移導致整頁重複時即視為抓完
+        new = 0
         for o in orders:
             od = o.get("OrderDetails", {})
+            txn = o.get("TxnId") or od.get("OrderNumber")
+            if txn:
+                if txn in seen:
+                    continue
+                seen.add(txn)
+            new += 1
             if (od.get("ShipClass") or "").strip().upper() != "UNSP_CG":
                 all_orders.append(o)
-
-        if len(orders) < PAGE_SIZE: break
-        page += 1
+        return new
+
+    def fetch(page):
+        data = _fetch_page(session, params, page)
+        return data.get("orders") or data.get("Orders") or []
+
+    # 先抓第 1 頁；不滿頁或整頁重複即停
+    data = _fetch_page(session, params, 1)
+    orders = data.get("orders") or data.get("Orders") or []
+    if not keep(orders) or len(orders) < PAGE_SIZE:
+        return all_orders
+
+    total_pages = _total_pages(data, PAGE_SIZE)
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as ex:
+        if total_pages:
+            # 已知總頁數：其餘頁一次全部並行抓（map 保持頁序）
+            for orders in ex.map(fetch, range(2, total_pages + 1)):
+                keep(orders)
+            return all_orders
+
+        # 不知總頁數：一批 FETCH_WORKERS 頁預抓，遇到不滿頁或整頁重複即停
+        page = 2
+        while True:
+            batch = range(page, page + FETCH_WORKERS)
+            last = False
+            for orders in ex.map(fetch, batch):
+                if not keep(orders) or len(orders) < PAGE_SIZE:
+                    last = True
+                    break
+            if last:
+                break
+            page += FETCH_WORKERS
     return all_orders
 
 # ---------- PDF 欄位建構 ----------
 def build_row_from_group(oid, group, wh_key: str):
+    # 空群組沒有可填的資料，直接略過
+    if not group:
+        return None, None
     first = group[0]
     to = first.get("To") or {}
     od = first.get("OrderDetails") or {}
@@ -286,38 +387,92 @@ def build_row_from_group(oid, group, wh_key: str):
         "Class1": "125",
     }
 
-    total_qty_sum = 0
-    for idx, od_item in enumerate(group, start=1):
-        desc_val = _desc_value_from_order(od_item)
-        qty = _qty_from_order(od_item)
-        if desc_val:
-            row[f"Desc_{idx}"] = desc_val
-            row[f"HU_Type_{idx}"]  = "piece"
-            row[f"Pkg_Type_{idx}"] = "piece"
-            row[f"HU_QTY_{idx}"]   = str(qty) if qty else ""
-            row[f"Pkg_QTY_{idx}"]  = str(qty) if qty else ""
-            total_qty_sum += qty
-            row[f"NMFC{idx}"] = "69420"
-            row[f"Class{idx}"] = "125"
+    # 只保留有品名的品項（idx 仍依合單內順序）
+    items = [(idx, view) for idx, view in enumerate(map(_project, group), start=1) if view.desc]
+    total_qty_sum = sum(view.qty for _, view in items)
+    for idx, view in items:
+        qty = str(view.qty) if view.qty else ""
+        row.update({
+            f"Desc_{idx}": view.desc,
+            f"HU_Type_{idx}": "piece",
+            f"Pkg_Type_{idx}": "piece",
+            f"HU_QTY_{idx}": qty,
+            f"Pkg_QTY_{idx}": qty,
+            f"NMFC{idx}": "69420",
+            f"Class{idx}": "125",
+        })
 
     row["NumPkgs1"] = str(total_qty_sum)
     row["Weight1"] = "130 lbs" if total_qty_sum <= 1 else f"{130 + (total_qty_sum - 1) * 30} lbs"
     return row, WH
 
-def fill_pdf(row: dict, out_path: str):
+@st.cache_resource(show_spinner=False)
+def _template_bytes():
+    # 模板只從磁碟讀一次（跨 rerun 保留），每份 BOL 由記憶體中的 bytes 開新文件
     if not os.path.exists(TEMPLATE_PDF):
         raise FileNotFoundError(f"找不到 BOL 模板：{TEMPLATE_PDF}")
-    doc = fitz.open(TEMPLATE_PDF)
-    for page in doc:
+    with open(TEMPLATE_PDF, "rb") as f:
+        return f.read()
+
+@st.cache_resource(show_spinner=False)
+def _field_map():
+    # 欄位名稱 -> (((頁碼, widget xref), ...), "checkbox"/"text")；只掃描模板一次（跨 rerun 保留）
+    doc = fitz.open(stream=_template_bytes(), filetype="pdf")
+    locations = {}
+    kinds = {}
+    for i, page in enumerate(doc):
         for w in (page.widgets() or []):
             name = w.field_name
-            if name and name in row:
-                set_widget_value(w, name, row[name])
+            if not name:
+                continue
+            locations.setdefault(name, []).append((i, w.xref))
+            if name not in kinds:
+                is_checkbox = (w.field_type == fitz.PDF_WIDGET_TYPE_CHECKBOX or name in CHECKBOX_FIELDS) \
+                    and name not in FORCE_TEXT_FIELDS
+                kinds[name] = "checkbox" if is_checkbox else "text"
+    doc.close()
+    return {name: (tuple(locs), kinds[name]) for name, locs in locations.items()}
+
+def fill_pdf_bytes(row: dict):
+    fields = _field_map()
+    doc = fitz.open(stream=_template_bytes(), filetype="pdf")
+    warnings = []
+    pages = {}
+    # 只處理 row 裡有、模板也有的欄位，依 xref 直接載入 widget
+    for name, value in row.items():
+        entry = fields.get(name)
+        if entry is None:
+            continue
+        locs, kind = entry
+        for pno, xref in locs:
+            # 單一欄位失敗不中斷整份 BOL，訊息收進 warnings 由呼叫端顯示
+            try:
+                page = pages.get(pno)
+                if page is None:
+                    page = pages[pno] = doc[pno]
+                FIELD_SETTERS[kind](page.load_widget(xref), value)
+            except Exception as e:
+                warnings.append(f"填欄位 {name} 失敗：{e}")
     try: doc.need_appearances = True
     except Exception: pass
-    os.makedirs(os.path.dirname(out_path), exist_ok=True)
-    doc.save(out_path, deflate=True, incremental=False, encryption=fitz.PDF_ENCRYPT_KEEP)
+    pdf_bytes = doc.tobytes(deflate=True, incremental=False, encryption=fitz.PDF_ENCRYPT_KEEP)
     doc.close()
+    return pdf_bytes, warnings
+
+def _make_one_bol(row_preview, grouped):
+    # 單一表格列 -> (檔名, PDF bytes, 警告)；找不到對應訂單時回傳 None
+    oid = row_preview.OriginalTxnId
+    row_dict, WH = build_row_from_group(oid, grouped.get(oid, []), row_preview.Warehouse)
+    if row_dict is None:
+        return None
+
+    # 檔名不含空白（SKU 或倉庫名稱內部也可能有空白）
+    wh2 = (WH["name"][:2].upper() if WH["name"] else "WH")
+    scac = (row_preview.SCAC or "").upper() or "NOSCAC"
+    filename = f"BOL_{oid}_{row_preview.SKU8 or 'NOSKU'}_{wh2}_{scac}.pdf".replace(" ", "")
+
+    pdf_bytes, warnings = fill_pdf_bytes(row_dict)
+    return filename, pdf_bytes, warnings
 
 # ---------- Streamlit UI ----------
 st.set_page_config(page_title=APP_TITLE, layout="wide")
@@ -348,39 +503,68 @@ if not TEAPPLIX_TOKEN:
 # 左側 Sidebar：天數下拉
 days = st.sidebar.selectbox("抓取天數", options=[1,2,3,4,5,6,7], index=2, help="預設 3 天（index=2）")
 
-# 操作：抓單
-if st.button("抓取訂單", use_container_width=True):
-    st.session_state["orders_raw"] = fetch_orders(days)
-    # 清掉之前的覆蓋資料
-    st.session_state.pop("table_rows_override", None)
+# 操作：抓單（5 分鐘內同樣天數走快取；強制重抓略過快取）
+fetch_col1, fetch_col2 = st.columns([5,1])
+with fetch_col1:
+    fetch_clicked = st.button("抓取訂單", use_container_width=True)
+with fetch_col2:
+    refetch_clicked = st.button("強制重抓", use_container_width=True, help="略過快取，直接向 Teapplix 重新抓取")
+if refetch_clicked:
+    fetch_orders.clear()
+    st.session_state.pop("date_cache", None)
+if fetch_clicked or refetch_clicked:
+    try:
+        st.session_state["orders_raw"] = fetch_orders(days, phoenix_today())
+    except TeapplixAPIError as e:
+        st.error(str(e))
+        st.session_state.pop("orders_raw", None)
+    # 清掉之前的合單快取（表格連同批次倉庫變更一起重建）
+    st.session_state.pop("groups_key", None)
 
 orders_raw = st.session_state.get("orders_raw", None)
 
 if orders_raw:
-    grouped = group_by_original_txn(orders_raw)
-
-    # 準備表格資料
-    if "table_rows_override" in st.session_state:
-        table_rows = st.session_state["table_rows_override"]
-    else:
-        table_rows = []
+    # 合單與表格基礎資料只在訂單變動時重算，其餘互動（勾選、改倉庫）直接沿用
+    groups_key = (id(orders_raw), len(orders_raw))
+    if st.session_state.get("groups_key") != groups_key:
+        grouped = group_by_original_txn(orders_raw)
+        # 訂單日期依 (PO, 第一筆訂單) 記住，重抓時只解析新出現的；只保留本次表格用到的項目
+        old_date_cache = st.session_state.get("date_cache", {})
+        date_cache = {}
+        # 直接逐欄（columnar）組 DataFrame，不再先建每列一個 dict
+        oids, sku8s, scacs, states, dates = [], [], [], [], []
         for oid, group in grouped.items():
             first = group[0]
             od = first.get("OrderDetails", {}) or {}
-            scac = (od.get("ShipClass") or "").strip()
-            sku8 = _sku8_from_order(first)
-            order_date_str = _parse_order_date_str(first)  # 只日期
-            table_rows.append({
-                "Select": True,
-                "Warehouse": "CA 91789",  # 預設
-                "OriginalTxnId": oid,
-                "SKU8": sku8,
-                "SCAC": scac,
-                "ToState": (first.get("To") or {}).get("State",""),
-                "OrderDate": order_date_str,
-            })
-
-    st.caption(f"共 {len(table_rows)} 筆（依 OriginalTxnId 合併）")
+            date_key = (oid, first.get("TxnId") or od.get("OrderNumber"))
+            order_date_str = old_date_cache.get(date_key)
+            if order_date_str is None:
+                order_date_str = _parse_order_date_str(first)  # 只日期
+            date_cache[date_key] = order_date_str
+            oids.append(oid)
+            sku8s.append(_project(first).sku8)
+            scacs.append((od.get("ShipClass") or "").strip())
+            states.append((first.get("To") or {}).get("State",""))
+            dates.append(order_date_str)
+        table_df = pd.DataFrame({
+            "Select": True,
+            "Warehouse": "CA 91789",  # 預設
+            "OriginalTxnId": oids,
+            "SKU8": sku8s,
+            "SCAC": scacs,
+            "ToState": states,
+            "OrderDate": dates,
+        }, columns=TABLE_COLUMNS)
+        st.session_state["grouped"] = grouped
+        st.session_state["date_cache"] = date_cache
+        st.session_state["table_df"] = table_df
+        st.session_state["groups_key"] = groups_key
+    grouped = st.session_state["grouped"]
+
+    # 準備表格資料（批次倉庫直接改寫這份 DataFrame）
+    table_df = st.session_state["table_df"]
+
+    st.caption(f"共 {len(table_df)} 筆（依 OriginalTxnId 合併）")
 
     # 批次修改倉庫（只改 Warehouse）
     bulk_col1, bulk_col2, bulk_col3 = st.columns([1,1,6])
@@ -390,72 +574,62 @@ if orders_raw:
         apply_to = st.selectbox("套用對象", options=["勾選列", "全部"], index=0)
     with bulk_col3:
         if st.button("套用批次倉庫", use_container_width=True):
-            new_rows = []
-            if apply_to == "全部":
-                for r in table_rows:
-                    r2 = dict(r)
-                    r2["Warehouse"] = bulk_wh
-                    new_rows.append(r2)
-            else:  # 勾選列
-                for r in table_rows:
-                    r2 = dict(r)
-                    if r2.get("Select"):
-                        r2["Warehouse"] = bulk_wh
-                    new_rows.append(r2)
-            st.session_state["table_rows_override"] = new_rows
-            table_rows = new_rows
+            mask = slice(None) if apply_to == "全部" else table_df["Select"].to_numpy()  # 全部 / 勾選列
+            table_df.loc[mask, "Warehouse"] = bulk_wh
             st.success("已套用批次倉庫變更。")
 
     # 表格（僅允許編輯 Warehouse 與 Select；其他欄位鎖定）
-    edited = st.data_editor(
-        table_rows,
-        num_rows="fixed",
-        use_container_width=True,
-        hide_index=True,
-        column_config={
-            "Select": st.column_config.CheckboxColumn("選取", default=True),  # 可編輯
-            "Warehouse": st.column_config.SelectboxColumn("倉庫", options=list(WAREHOUSES.keys())),  # 可編輯
-            "OriginalTxnId": st.column_config.TextColumn("PO", disabled=True),
-            "SKU8": st.column_config.TextColumn("SKU", disabled=True),
-            "SCAC": st.column_config.TextColumn("SCAC", disabled=True),
-            "ToState": st.column_config.TextColumn("州", disabled=True),
-            "OrderDate": st.column_config.TextColumn("訂單日期 (mm/dd/yy)", disabled=True),
-        },
-        key="orders_table",
-    )
-
-    # 產出 BOL
-    if st.button("產生 BOL（勾選列）", type="primary", use_container_width=True):
-        selected = [r for r in edited if r.get("Select")]
-        if not selected:
+    # 放在 form 內：勾選 / 改倉庫只在瀏覽器端暫存，按下產生時才 rerun 一次
+    with st.form("bol_form", clear_on_submit=False):
+        edited = st.data_editor(
+            table_df,
+            num_rows="fixed",
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "Select": st.column_config.CheckboxColumn("選取", default=True),  # 可編輯
+                "Warehouse": st.column_config.SelectboxColumn("倉庫", options=list(WAREHOUSES.keys())),  # 可編輯
+                "OriginalTxnId": st.column_config.TextColumn("PO", disabled=True),
+                "SKU8": st.column_config.TextColumn("SKU", disabled=True),
+                "SCAC": st.column_config.TextColumn("SCAC", disabled=True),
+                "ToState": st.column_config.TextColumn("州", disabled=True),
+                "OrderDate": st.column_config.TextColumn("訂單日期 (mm/dd/yy)", disabled=True),
+            },
+            key="orders_table",
+        )
+        save_local = st.checkbox(f"另存一份到 {OUTPUT_DIR}/", value=False)
+        submitted = st.form_submit_button("產生 BOL（勾選列）", type="primary", use_container_width=True)
+
+    # 產出 BOL（下載按鈕不能放在 form 內）
+    if submitted:
+        selected = edited.loc[edited["Select"].to_numpy(dtype=bool)]
+        if selected.empty:
             st.warning("尚未選取任何訂單。")
         else:
-            os.makedirs(OUTPUT_DIR, exist_ok=True)
-            made_files = []
-            for row_preview in selected:
-                oid = row_preview["OriginalTxnId"]
-                wh_key = row_preview["Warehouse"]
-                group = grouped.get(oid, [])
-                if not group:
-                    continue
-
-                row_dict, WH = build_row_from_group(oid, group, wh_key)
-
-                sku8 = row_preview["SKU8"] or (_sku8_from_order(group[0]) or "NOSKU")[:8]
-                wh2 = (WH["name"][:2].upper() if WH["name"] else "WH")
-                scac = (row_preview["SCAC"] or "").upper() or "NOSCAC"
-                filename = f"BOL_{oid}_{sku8}_{wh2}_{scac}.pdf".replace(" ", "")
-                out_path = os.path.join(OUTPUT_DIR, filename)
-
-                fill_pdf(row_dict, out_path)
-                made_files.append(out_path)
-
-            if made_files:
-                st.success(f"已產生 {len(made_files)} 份 BOL。")
-                mem_zip = io.BytesIO()
-                with zipfile.ZipFile(mem_zip, "w", zipfile.ZIP_DEFLATED) as zf:
-                    for p in made_files:
-                        zf.write(p, arcname=os.path.basename(p))
+            # 逐份產生（PyMuPDF 不支援多執行緒）；產好一份就直接寫進記憶體中的 ZIP，不落地（除非勾選另存）
+            rows = list(selected.itertuples(index=False))
+            _field_map()  # 先在主執行緒建好欄位索引（模板缺檔也在此先報錯）
+            if save_local:
+                os.makedirs(OUTPUT_DIR, exist_ok=True)
+            made_count = 0
+            mem_zip = io.BytesIO()
+            # BOL 模板多為未壓縮的物件字典，ZIP 仍要壓縮；level 1 即可拿到大部分壓縮率、CPU 最省
+            with zipfile.ZipFile(mem_zip, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+                for row_preview in rows:
+                    result = _make_one_bol(row_preview, grouped)
+                    if result is None:
+                        continue
+                    filename, blob, warnings = result
+                    for msg in warnings:
+                        st.warning(msg)
+                    zf.writestr(filename, blob)
+                    if save_local:
+                        with open(os.path.join(OUTPUT_DIR, filename), "wb") as f:
+                            f.write(blob)
+                    made_count += 1
+
+            if made_count:
+                st.success(f"已產生 {made_count} 份 BOL。")
                 mem_zip.seek(0)
                 st.download_button(
                     "下載全部 BOL (ZIP)",